@@ -5,6 +5,13 @@ import logging
 import simplejson
 import yaml
 import os
+from cumulus.exceptions import InvalidStackDefinition
+
+# Use the libyaml backed loader when it's available, it's much faster
+try:
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
 
 
 class CFStack(object):
@@ -12,28 +19,28 @@ class CFStack(object):
     CFstack object represents a CloudFormation stack including its parameters,
     template and what other stacks it depends on.
     """
+    # Parsed templates shared by all stacks, keyed by path, mtime and size so
+    # stacks using the same template file only parse it once per run and an
+    # edited file is parsed again
+    template_cache = {}
+
     def __init__(self, mega_stack_name, name, params, template_name, cfconn,
-                 sns_topic_arn, tags=None, depends_on=None):
+                 sns_topic_arn, tags=None, depends_on=None,
+                 cf_stacks_resources=None):
         self.logger = logging.getLogger(__name__)
-        if mega_stack_name == name:
-            self.cf_stack_name = name
-        else:
-            self.cf_stack_name = "%s-%s" % (mega_stack_name, name)
         self.mega_stack_name = mega_stack_name
+        self.cf_stack_prefix = "%s-" % mega_stack_name
+        self.cf_stack_name = self.cf_name(name)
         self.name = name
         self.yaml_params = params
         self.params = {}
         self.template_name = template_name
         self.template_body = ''
+        self.template_dict = None
         if depends_on is None:
             self.depends_on = None
         else:
-            self.depends_on = []
-            for dep in depends_on:
-                if dep == mega_stack_name:
-                    self.depends_on.append(dep)
-                else:
-                    self.depends_on.append("%s-%s" % (mega_stack_name, dep))
+            self.depends_on = [self.cf_name(dep) for dep in depends_on]
         self.sns_topic_arn = sns_topic_arn
         self.cfconn = cfconn
 
@@ -43,22 +50,37 @@ class CFStack(object):
         else:
             self.tags = tags
 
-        try:
-            open(template_name, 'r')
-        except:
-            self.logger.critical("Failed to open template file %s for stack %s"
-                                 % (self.template_name, self.name))
-            exit(1)
+        if not (os.path.isfile(template_name) and
+                os.access(template_name, os.R_OK)):
+            raise InvalidStackDefinition(
+                "Failed to open template file %s for stack %s"
+                % (self.template_name, self.name))
 
         # check params is a dict if set
-        if self.yaml_params and type(self.yaml_params) is not dict:
-            self.logger.critical(
-                "Parameters for stack %s must be of type dict not %s",
-                self.name, type(self.yaml_params))
-            exit(1)
+        if self.yaml_params and not isinstance(self.yaml_params, dict):
+            raise InvalidStackDefinition(
+                "Parameters for stack %s must be of type dict not %s"
+                % (self.name, type(self.yaml_params)))
 
         self.cf_stacks = {}
-        self.cf_stacks_resources = {}
+        self.cf_stacks_index = {}
+        self.cf_stacks_seeded = False
+        # Resource listings of CloudFormation stacks. MegaStack passes the
+        # same dict to all its stacks so a source stack used by several
+        # others is only listed once, and drops entries when it changes a
+        # stack.
+        if cf_stacks_resources is None:
+            self.cf_stacks_resources = {}
+        else:
+            self.cf_stacks_resources = cf_stacks_resources
+
+    def cf_name(self, name):
+        """
+        Get the CloudFormation name of a stack in this mega stack
+        """
+        if name == self.mega_stack_name:
+            return name
+        return self.cf_stack_prefix + name
 
     def deps_met(self, current_cf_stacks):
         """
@@ -66,25 +88,14 @@ class CFStack(object):
         """
         if self.depends_on is None:
             return True
-        else:
-            for dep in self.depends_on:
-                dep_met = False
-                # check CF if stack we depend on has been created successfully
-                for stack in current_cf_stacks:
-                    if str(stack.stack_name) == dep:
-                        dep_met = True
-                if not dep_met:
-                    return False
-            return True
+        # check CF if stacks we depend on have been created successfully
+        return all(dep in current_cf_stacks for dep in self.depends_on)
 
     def exists_in_cf(self, current_cf_stacks):
         """
         Check if this stack exists in CloudFormation
         """
-        for stack in current_cf_stacks:
-            if str(stack.stack_name) == self.cf_stack_name:
-                return stack
-        return False
+        return current_cf_stacks.get(self.cf_stack_name, False)
 
     def populate_params(self, current_cf_stacks):
         """
@@ -96,19 +107,24 @@ class CFStack(object):
             self.params = {}
             return True
         if self.deps_met(current_cf_stacks):
-            for param_name, param_val in self.yaml_params.iteritems():
-                if type(param_val) is dict:
-                    self.params[param_name] = self._parse_param(
-                        param_name, param_val)
+            # The DescribeStacks listing already holds parameters and
+            # outputs for every stack, so seed the cache from it instead of
+            # describing each source stack again
+            self.cf_stacks.update(current_cf_stacks)
+            self.cf_stacks_seeded = True
+            self.cf_stacks_index = {}
+            params = self.params
+            parse_param = self._parse_param
+            for param_name, param_val in self.yaml_params.items():
+                if isinstance(param_val, dict):
+                    params[param_name] = parse_param(param_name, param_val)
                 # If param_val is a list it means there is an array of vars
                 # we need to turn into a comma sep list.
-                elif type(param_val) is list:
-                    param_list = []
-                    for item in param_val:
-                        if type(item) is dict:
-                            param_list.append(self._parse_param(
-                                param_name, str(item['value'])))
-                    self.params[param_name] = ','.join(param_list)
+                # Each item is parsed the same way as a single param.
+                elif isinstance(param_val, list):
+                    params[param_name] = ','.join(
+                        parse_param(param_name, item)
+                        for item in param_val if isinstance(item, dict))
             return True
         else:
             return False
@@ -132,20 +148,15 @@ class CFStack(object):
         elif ('source' in param_dict and
               'type' in param_dict and
               'variable' in param_dict):
-            if param_dict['source'] == self.mega_stack_name:
-                source_stack = param_dict['source']
-            else:
-                source_stack = ("%s-%s" %
-                                (self.mega_stack_name, param_dict['source']))
             return self.get_value_from_cf(
-                source_stack=source_stack,
+                source_stack=self.cf_name(param_dict['source']),
                 var_type=param_dict['type'],
                 var_name=param_dict['variable'])
         else:
             error_message = ("Error in yaml file, can't parse parameter %s" +
                              " for %s stack.")
-            self.logger.critical(error_message, param_name, self.name)
-            exit(1)
+            raise InvalidStackDefinition(error_message
+                                         % (param_name, self.name))
 
     def get_cf_stack(self, stack, resources=False):
         """
@@ -154,6 +165,13 @@ class CFStack(object):
         """
         if not resources:
             if stack not in self.cf_stacks:
+                # The listing we were seeded from holds every stack in the
+                # region, so a stack missing from it doesn't exist and
+                # there's no point asking CF again
+                if self.cf_stacks_seeded:
+                    raise InvalidStackDefinition(
+                        "Source stack %s for stack %s doesn't exist in"
+                        " CloudFormation" % (stack, self.name))
                 # We don't have this stack in the cache already
                 # so we need to pull it from CF
                 self.cf_stacks[stack] = self.cfconn.describe_stacks(stack)[0]
@@ -161,9 +179,27 @@ class CFStack(object):
         else:
             if stack not in self.cf_stacks_resources:
                 the_stack = self.get_cf_stack(stack=stack, resources=False)
-                self.cf_stacks_resources[stack] = the_stack.list_resources()
+                self.cf_stacks_resources[stack] = self._list_all_resources(
+                    the_stack)
             return self.cf_stacks_resources[stack]
 
+    def _list_all_resources(self, the_stack):
+        """
+        Get all pages of resources from list_stack_resources API call.
+        Goes through our connection rather than the stack's own so throttled
+        calls are retried.
+        """
+        result = []
+        resp = self.cfconn.list_stack_resources(
+            stack_name_or_id=the_stack.stack_id)
+        result.extend(resp)
+        while resp.next_token:
+            resp = self.cfconn.list_stack_resources(
+                stack_name_or_id=the_stack.stack_id,
+                next_token=resp.next_token)
+            result.extend(resp)
+        return result
+
     def get_value_from_cf(self, source_stack, var_type, var_name):
         """
         Get a variable from a existing cloudformation stack, var_type should be
@@ -171,54 +207,66 @@ class CFStack(object):
         If using resource, provide the logical ID and this will return the
         Physical ID
         """
-        the_stack = self.get_cf_stack(stack=source_stack)
-        if var_type == 'parameter':
-            for param in the_stack.parameters:
-                if str(param.key) == var_name:
-                    return str(param.value)
-        elif var_type == 'output':
-            for output in the_stack.outputs:
-                if str(output.key) == var_name:
-                    return str(output.value)
-        elif var_type == 'resource':
-            for res in self.get_cf_stack(stack=source_stack, resources=True):
-                if str(res.logical_resource_id) == var_name:
-                    return str(res.physical_resource_id)
-        else:
+        if var_type not in ('parameter', 'output', 'resource'):
             error_message = ("Error: invalid var_type passed to" +
                              " get_value_from_cf, needs to be parameter, " +
                              "resource or output. Not: %s")
-            self.logger.critical(error_message, (var_type))
-            exit(1)
+            raise InvalidStackDefinition(error_message % var_type)
+        return self.get_cf_index(source_stack, var_type).get(var_name)
+
+    def get_cf_index(self, stack, var_type):
+        """
+        Get the parameters, outputs or resources of a stack as a dict keyed
+        by name and cache it, so repeated lookups don't rescan the lists
+        """
+        if (stack, var_type) not in self.cf_stacks_index:
+            if var_type == 'parameter':
+                index = dict((param.key, str(param.value))
+                             for param in self.get_cf_stack(stack).parameters)
+            elif var_type == 'output':
+                index = dict((output.key, str(output.value))
+                             for output in self.get_cf_stack(stack).outputs)
+            else:
+                index = dict((res.logical_resource_id,
+                              str(res.physical_resource_id))
+                             for res in self.get_cf_stack(stack,
+                                                          resources=True))
+            self.cf_stacks_index[(stack, var_type)] = index
+        return self.cf_stacks_index[(stack, var_type)]
 
     def get_params_tuples(self):
         """
         Convert param dict to array of tuples needed by boto
         """
-        tuple_list = []
-        if len(self.params) > 0:
-            for param in self.params.keys():
-                tuple_list.append((param, self.params[param]))
-        return tuple_list
+        return list(self.params.items())
 
     def read_template(self):
         """
         Open and parse the yaml/json template for this stack
         """
         try:
-            template_file = open(self.template_name, 'r')
-            template = yaml.load(template_file)
+            template_stat = os.stat(self.template_name)
+            cache_key = (os.path.abspath(self.template_name),
+                         template_stat.st_mtime, template_stat.st_size)
+            if cache_key not in self.template_cache:
+                with open(self.template_name, 'r') as template_file:
+                    template = yaml.load(template_file, Loader=YamlLoader)
+                template_body = simplejson.dumps(
+                    template,
+                    sort_keys=True,
+                    indent=2,
+                    separators=(',', ': '),
+                )
+                # Keep the dict as it reads back from the JSON we upload,
+                # e.g. with integer keys turned into strings, so it compares
+                # equal to the template CF gives back
+                self.template_cache[cache_key] = (
+                    simplejson.loads(template_body), template_body)
         except Exception as exception:
-            self.logger.critical("Cannot parse %s template for stack %s."
-                                 " Error: %s", self.template_name, self.name,
-                                 exception)
-            exit(1)
-        self.template_body = simplejson.dumps(
-            template,
-            sort_keys=True,
-            indent=2,
-            separators=(',', ': '),
-        )
+            raise InvalidStackDefinition(
+                "Cannot parse %s template for stack %s. Error: %s"
+                % (self.template_name, self.name, exception))
+        self.template_dict, self.template_body = self.template_cache[cache_key]
         return True
 
     def template_uptodate(self, current_cf_stacks):
@@ -229,10 +277,22 @@ class CFStack(object):
         """
         cf_stack = self.exists_in_cf(current_cf_stacks)
         if cf_stack:
-            cf_temp_res = cf_stack.get_template()['GetTemplateResponse']
+            # Through our connection rather than cf_stack.get_template() so
+            # throttled calls are retried
+            cf_temp_res = self.cfconn.get_template(
+                stack_name_or_id=cf_stack.stack_id)['GetTemplateResponse']
             cf_temp_body = cf_temp_res['GetTemplateResult']['TemplateBody']
-            cf_temp_dict = yaml.load(cf_temp_body)
-            if cf_temp_dict == yaml.load(self.template_body):
+            # Templates uploaded by cumulus come back exactly as we sent
+            # them, so skip parsing when the bodies are identical
+            if cf_temp_body == self.template_body:
+                return True
+            # Bodies are normally the JSON we uploaded, so try the much
+            # faster JSON parser before falling back to YAML
+            try:
+                cf_temp_dict = simplejson.loads(cf_temp_body)
+            except ValueError:
+                cf_temp_dict = yaml.load(cf_temp_body, Loader=YamlLoader)
+            if cf_temp_dict == self.template_dict:
                 return True
         return False
 
@@ -244,18 +304,22 @@ class CFStack(object):
         if not cf_stack:
             return False
 
+        cf_params = dict((param.key, param.value)
+                         for param in cf_stack.parameters)
+        if cf_params == self.params:
+            return True
+
+        # Something has changed, work out what for the debug log.
         # If number of params in CF and this stack obj dont match,
         # then it needs updating
-        if len(cf_stack.parameters) != len(self.params):
+        if len(cf_params) != len(self.params):
             msg = "New and old parameter lists are different lengths for %s"
             self.logger.debug(msg, self.name)
             return False
 
-        for param in cf_stack.parameters:
+        for key, value in cf_params.items():
             # check if param in CF exists in our new parameter set,
             # if not they are differenet and need updating
-            key = param.key
-            value = param.value
             if key not in self.params:
                 msg = ("New params are missing key %s that exists in CF " +
                        "for %s stack already.")
@@ -267,6 +331,4 @@ class CFStack(object):
                 self.logger.debug(msg, key, self.name,
                                   value, self.params[key])
                 return False
-
-        # We got to the end without returning False, so must be fine.
-        return True
+        return False
@@ -9,11 +9,37 @@ import time
 import yaml
 import pystache
 import os
-from cumulus.CFStack import CFStack
-from boto import cloudformation, iam, sts
+import sys
+from collections import OrderedDict, deque
+from itertools import islice
+from cumulus.CFStack import CFStack, YamlLoader
+from cumulus.exceptions import (CumulusException, ConfigError,
+                                InvalidStackDefinition, StackOperationError)
+from cumulus.RetryingConnection import RetryingConnection
+from boto import cloudformation
 from boto.exception import BotoServerError
 
 
+class OrderedYamlLoader(YamlLoader):
+    """
+    YAML loader that keeps mappings in the order they're written, so stacks
+    without dependencies between them are processed in file order
+    """
+
+
+def _construct_ordered_mapping(loader, node):
+    loader.flatten_mapping(node)
+    return OrderedDict(loader.construct_pairs(node))
+
+
+OrderedYamlLoader.add_constructor(
+    yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
+    _construct_ordered_mapping)
+
+# pystache.render builds a new Renderer on every call, so keep one around
+RENDERER = pystache.Renderer()
+
+
 class MegaStack(object):
     """
     Main worker class for cumulus. Holds array of CFstack objects and does most
@@ -22,45 +48,59 @@ class MegaStack(object):
     def __init__(self, yamlFile):
         self.logger = logging.getLogger(__name__)
 
-        # load the yaml file and turn it into a dict
-        thefile = open(yamlFile, 'r')
-
-        rendered_file = pystache.render(thefile.read(), dict(os.environ))
+        if YamlLoader is yaml.SafeLoader:
+            self.logger.warning("PyYAML was built without libyaml, parsing"
+                                " yaml will be slow. See the README for how"
+                                " to install it.")
 
-        self.stackDict = yaml.safe_load(rendered_file)
+        # load the yaml file and turn it into a dict
+        try:
+            with open(yamlFile, 'r') as thefile:
+                mega_stack_source = thefile.read()
+        except IOError as exception:
+            raise ConfigError("Cannot read yaml file %s: %s"
+                              % (yamlFile, exception))
+        rendered_file = RENDERER.render(mega_stack_source, dict(os.environ))
+
+        self.stackDict = yaml.load(rendered_file, Loader=OrderedYamlLoader)
         # Make sure there is only one top level element in the yaml file
-        if len(self.stackDict.keys()) != 1:
-            error_message = ("Need one and only one mega stack name at the" +
-                             " top level, found %s")
-            self.logger.critical(error_message % len(self.stackDict.keys()))
-            exit(1)
+        if len(self.stackDict) != 1:
+            raise ConfigError(
+                "Need one and only one mega stack name at the top level,"
+                " found %s" % len(self.stackDict))
 
         # Now we know we only have one top element,
         # that must be the mega stack name
-        self.name = self.stackDict.keys()[0]
+        self.name = next(iter(self.stackDict))
+        # Everything else in the file lives under the mega stack name
+        self.config = self.stackDict[self.name]
 
-        # Find and set the mega stacks region. Exit if we can't find it
-        if 'region' in self.stackDict[self.name]:
-            self.region = self.stackDict[self.name]['region']
+        # Find and set the mega stacks region. Fail if we can't find it
+        if 'region' in self.config:
+            self.region = self.config['region']
         else:
-            self.logger.critical("No region specified for mega stack," +
-                                 " don't know where to build it.")
-            exit(1)
+            raise ConfigError("No region specified for mega stack,"
+                              " don't know where to build it.")
 
         # Find and set the mega stack's AWS profile
-        if 'aws_profile' in self.stackDict[self.name]:
-            self.aws_profile = self.stackDict[self.name]['aws_profile']
+        if 'aws_profile' in self.config:
+            self.aws_profile = self.config['aws_profile']
         else:
             self.aws_profile = None
 
         # Find and set the mega stack's STS role ARN
-        if 'sts_role' in self.stackDict[self.name]:
-            self.sts_role = self.stackDict[self.name]['sts_role']
+        if 'sts_role' in self.config:
+            self.sts_role = self.config['sts_role']
         else:
             self.sts_role = None
 
+        # ARN of the identity our credentials belong to, if we already know it
+        credentials_arn = None
+
         # Connect to STS and assume the provided role
         if self.sts_role is not None:
+            # Only needed when assuming a role, so don't load it otherwise
+            from boto import sts
             try:
                 stsconn = sts.connect_to_region(self.region,
                                                 profile_name=self.aws_profile)
@@ -69,13 +109,13 @@ class MegaStack(object):
                 self.aws_access_key_id = role.credentials.access_key
                 self.aws_secret_access_key = role.credentials.secret_key
                 self.aws_session_token = role.credentials.session_token
+                credentials_arn = role.user.arn
                 self.logger.info("Using STS credentials to set up stack, stack"
                                  + " creation may fail if it takes longer than"
                                  + " 1 hour")
             except BotoServerError as e:
-                self.logger.critical("Could not assume STS role")
-                self.logger.critical(e.message)
-                exit(1)
+                raise ConfigError("Could not assume STS role %s: %s"
+                                  % (self.sts_role, e.message))
         else:
             self.aws_access_key_id = None
             self.aws_secret_access_key = None
@@ -95,70 +135,69 @@ class MegaStack(object):
                 kwargs['profile_name'] = self.aws_profile
             return service.connect_to_region(self.region, **kwargs)
 
-        if 'account_id' in self.stackDict[self.name]:
-            # Get the account ID for the current AWS credentials
-            iamconn = connect(iam)
-            user_response = iamconn.get_user()['get_user_response']
-            user_result = user_response['get_user_result']
-            account_id = user_result['user']['arn'].split(':')[4]
+        if 'account_id' in self.config:
+            # Get the account ID for the current AWS credentials. The
+            # assumed role's ARN already has it, otherwise ask IAM
+            if credentials_arn is None:
+                from boto import iam
+                iamconn = connect(iam)
+                user_response = iamconn.get_user()['get_user_response']
+                user_result = user_response['get_user_result']
+                credentials_arn = user_result['user']['arn']
+            account_id = credentials_arn.split(':', 5)[4]
 
             # Check if the current account ID matches the stack's account ID
-            if account_id != str(self.stackDict[self.name]['account_id']):
-                self.logger.critical("Account ID of stack does not match the" +
-                                     " account ID of your AWS credentials.")
-                exit(1)
+            if account_id != str(self.config['account_id']):
+                raise ConfigError("Account ID of stack does not match the"
+                                  " account ID of your AWS credentials.")
 
-        self.sns_topic_arn = self.stackDict[self.name].get('sns-topic-arn', [])
+        self.sns_topic_arn = self.config.get('sns-topic-arn', [])
         if isinstance(self.sns_topic_arn, str):
             self.sns_topic_arn = [self.sns_topic_arn]
-        for topic in self.sns_topic_arn:
-            if topic.split(':')[3] != self.region:
-                self.logger.critical("SNS Topic %s is not in the %s region."
-                                     % (topic, self.region))
-                exit(1)
+        # Topics already found to be in our region, stacks usually inherit
+        # the global topics so most only need checking once
+        self.checked_sns_topics = set()
+        self._check_sns_topics(self.sns_topic_arn)
 
-        self.global_tags = self.stackDict[self.name].get('tags', {})
+        self.global_tags = self.config.get('tags', {})
         # Array for holding CFStack objects once we create them
         self.stack_objs = []
+        # Resource listings of CloudFormation stacks, shared by our stacks so
+        # a source stack is only listed once. Kept per mega stack because
+        # stack names are only unique within one account and region.
+        self.cf_stacks_resources = {}
 
         # Get the names of the sub stacks from the yaml file and sort in array
-        self.cf_stacks = self.stackDict[self.name]['stacks'].keys()
+        self.cf_stacks = list(self.config['stacks'])
 
         # Megastack holds the connection to CloudFormation and list of stacks
         # currently in our region stops us making lots of calls to
         # CloudFormation API for each stack
         try:
-            self.cfconn = connect(cloudformation)
+            self.cfconn = RetryingConnection(connect(cloudformation))
             self.cf_desc_stacks = self._describe_all_stacks()
         except boto.exception.NoAuthHandlerFound as exception:
-            self.logger.critical(
+            raise ConfigError(
                 "No credentials found for connecting to CloudFormation: %s"
                 % exception)
-            exit(1)
 
         # iterate through the stacks in the yaml file and create CFstack
         # objects for them
-        for stack_name in self.cf_stacks:
-            the_stack = self.stackDict[self.name]['stacks'][stack_name]
-            if type(the_stack) is dict:
+        for stack_name, the_stack in self.config['stacks'].items():
+            if isinstance(the_stack, dict):
                 if the_stack.get('disable', False):
                     warn_message = ("Stack %s is disabled by configuration" +
                                     " directive. Skipping")
-                    self.logger.warning(warn_message % stack_name)
+                    self.logger.warning(warn_message, stack_name)
                     continue
                 local_sns_arn = the_stack.get('sns-topic-arn',
                                               self.sns_topic_arn)
                 if isinstance(local_sns_arn, str):
                     local_sns_arn = [local_sns_arn]
-                for topic in local_sns_arn:
-                    if topic.split(':')[3] != self.region:
-                        error_message = "SNS Topic %s is not in the %s region."
-                        self.logger.critical(error_message
-                                             % (topic, self.region))
-                        exit(1)
+                self._check_sns_topics(local_sns_arn)
                 local_tags = the_stack.get('tags', {})
-                merged_tags = dict(self.global_tags.items() +
-                                   local_tags.items())
+                merged_tags = dict(self.global_tags)
+                merged_tags.update(local_tags)
                 # Add static cumulus-stack tag
                 merged_tags['cumulus-stack'] = self.name
                 if 'cf_template' in the_stack:
@@ -171,54 +210,98 @@ class MegaStack(object):
                             cfconn=self.cfconn,
                             sns_topic_arn=local_sns_arn,
                             depends_on=the_stack.get('depends'),
-                            tags=merged_tags
+                            tags=merged_tags,
+                            cf_stacks_resources=self.cf_stacks_resources
                         )
                     )
+        self.stacks_by_name = dict((stack.name, stack)
+                                   for stack in self.stack_objs)
+
+    def _check_sns_topics(self, topics):
+        """
+        Raise ConfigError if any of the SNS topic ARNs given aren't in our
+        region
+        """
+        for topic in topics:
+            if topic in self.checked_sns_topics:
+                continue
+            # Region is the fourth field of arn:aws:sns:region:account:name
+            if topic.split(':', 4)[3] != self.region:
+                raise ConfigError("SNS Topic %s is not in the %s region."
+                                  % (topic, self.region))
+            self.checked_sns_topics.add(topic)
 
     def sort_stacks_by_deps(self):
         """
         Sort the array of stack_objs so they are in dependancy order
         """
         sorted_stacks = []
-        dep_graph = {}
-        no_deps = []
+        # Number of dependencies each stack is still waiting on and the
+        # stacks waiting on each CF stack name
+        unmet_deps = {}
+        dependants = {}
+        no_deps = deque()
+        stacks_by_cf_name = dict((stack.cf_stack_name, stack)
+                                 for stack in self.stack_objs)
         # Add all stacks without dependancies to no_deps
         for stack in self.stack_objs:
-            if stack.depends_on is None:
+            deps = set(stack.depends_on or [])
+            for dep in deps:
+                if dep not in stacks_by_cf_name:
+                    raise InvalidStackDefinition(
+                        "Could not resolve dependency order. Stack %s "
+                        "depends on %s which is not in yaml file or is "
+                        "disabled." % (stack.name, dep))
+            unmet_deps[stack.name] = len(deps)
+            for dep in deps:
+                dependants.setdefault(dep, []).append(stack)
+            if not deps:
                 no_deps.append(stack)
-            else:
-                dep_graph[stack.name] = stack.depends_on[:]
-        # Perform a topological sort on stacks in dep_graph
-        while len(no_deps) > 0:
-            stack = no_deps.pop()
+        # Perform a topological sort (Kahn's algorithm) on the stacks
+        while no_deps:
+            stack = no_deps.popleft()
             sorted_stacks.append(stack)
-            for node in dep_graph.keys():
-                for deps in dep_graph[node]:
-                    if stack.cf_stack_name == deps:
-                        dep_graph[node].remove(stack.cf_stack_name)
-                        if len(dep_graph[node]) < 1:
-                            for stack_obj in self.stack_objs:
-                                if stack_obj.name == node:
-                                    no_deps.append(stack_obj)
-                            del dep_graph[node]
-        if len(dep_graph) > 0:
-            self.logger.critical("Could not resolve dependency order." +
-                                 " Either circular dependency or " +
-                                 "dependency on stack not in yaml file.")
-            exit(1)
+            for dependant in dependants.get(stack.cf_stack_name, []):
+                unmet_deps[dependant.name] -= 1
+                if unmet_deps[dependant.name] == 0:
+                    no_deps.append(dependant)
+        if len(sorted_stacks) < len(self.stack_objs):
+            # Every stack left over is waiting on another left over stack,
+            # so following those dependencies must lead round a cycle
+            stack = next(stack for stack in self.stack_objs
+                         if unmet_deps[stack.name] > 0)
+            path = []
+            while stack.name not in path:
+                path.append(stack.name)
+                stack = next(stacks_by_cf_name[dep]
+                             for dep in stack.depends_on
+                             if unmet_deps[stacks_by_cf_name[dep].name] > 0)
+            cycle = path[path.index(stack.name):] + [stack.name]
+            raise InvalidStackDefinition(
+                "Could not resolve dependency order. Circular dependency: %s"
+                % " -> ".join(cycle))
         else:
             self.stack_objs = sorted_stacks
             return True
 
+    def _selected_stacks(self, stack_name):
+        """
+        Get the stacks an action should run on in dependency order, all of
+        them or just the named one if a stack name was given
+        """
+        if not stack_name:
+            return self.stack_objs
+        if stack_name in self.stacks_by_name:
+            return [self.stacks_by_name[stack_name]]
+        return []
+
     def check(self, stack_name=None):
         """
         Checks the status of the yaml file.
         Displays parameters for the stacks it can.
         """
-        for stack in self.stack_objs:
-            if stack_name and stack.name != stack_name:
-                continue
-            self.logger.info("Starting check of stack %s" % stack.name)
+        for stack in self._selected_stacks(stack_name):
+            self.logger.info("Starting check of stack %s", stack.name)
             if not stack.populate_params(self.cf_desc_stacks):
                 info_message = ("Could not determine correct parameters for" +
                                 "CloudFormation stack %s\n\tMost likely " +
@@ -227,47 +310,44 @@ class MegaStack(object):
                 self.logger.info(info_message, stack.name)
             else:
                 self.logger.info("Stack %s would be created with following "
-                                 "parameter values: %s"
-                                 % (stack.cf_stack_name,
-                                    stack.get_params_tuples()))
-                self.logger.info("Stack %s already exists in CF: %s"
-                                 % (stack.cf_stack_name,
-                                    bool(stack.exists_in_cf(
-                                         self.cf_desc_stacks))))
+                                 "parameter values: %s",
+                                 stack.cf_stack_name,
+                                 stack.get_params_tuples())
+                self.logger.info("Stack %s already exists in CF: %s",
+                                 stack.cf_stack_name,
+                                 bool(stack.exists_in_cf(
+                                      self.cf_desc_stacks)))
 
     def create(self, stack_name=None):
         """
         Create all stacks in the yaml file.
         Any that already exist are skipped (no attempt to update)
         """
-        for stack in self.stack_objs:
-            if stack_name and stack.name != stack_name:
-                continue
-            self.logger.info("Starting checks for creation of stack: %s"
-                             % stack.name)
+        for stack in self._selected_stacks(stack_name):
+            self.logger.info("Starting checks for creation of stack: %s",
+                             stack.name)
             if stack.exists_in_cf(self.cf_desc_stacks):
                 self.logger.info("Stack %s already exists in CloudFormation,"
-                                 " skipping" % stack.name)
+                                 " skipping", stack.name)
             else:
                 if stack.deps_met(self.cf_desc_stacks) is False:
-                    self.logger.critical("Dependancies for stack %s not met"
-                                         " and they should be, exiting..."
-                                         % stack.name)
-                    exit(1)
+                    raise StackOperationError(
+                        "Dependancies for stack %s not met and they should"
+                        " be, exiting..." % stack.name)
                 if not stack.populate_params(self.cf_desc_stacks):
-                    self.logger.critical("Could not determine correct "
-                                         "parameters for stack %s"
-                                         % stack.name)
-                    exit(1)
+                    raise StackOperationError(
+                        "Could not determine correct parameters for stack %s"
+                        % stack.name)
 
                 stack.read_template()
-                self.logger.info("Creating: %s, %s" % (
-                    stack.cf_stack_name, stack.get_params_tuples()))
+                params = stack.get_params_tuples()
+                self.logger.info("Creating: %s, %s",
+                                 stack.cf_stack_name, params)
                 try:
                     self.cfconn.create_stack(
                         stack_name=stack.cf_stack_name,
                         template_body=stack.template_body,
-                        parameters=stack.get_params_tuples(),
+                        parameters=params,
                         capabilities=[
                             'CAPABILITY_IAM',
                             'CAPABILITY_NAMED_IAM'],
@@ -275,66 +355,72 @@ class MegaStack(object):
                         tags=stack.tags
                     )
                 except Exception as exception:
-                    self.logger.critical(
-                        "Creating stack %s failed. Error: %s" % (
-                            stack.cf_stack_name, exception))
-                    exit(1)
+                    raise StackOperationError(
+                        "Creating stack %s failed. Error: %s"
+                        % (stack.cf_stack_name, exception))
 
                 create_result = self.watch_events(
                     stack.cf_stack_name, "CREATE_IN_PROGRESS")
                 if create_result != "CREATE_COMPLETE":
-                    self.logger.critical(
+                    raise StackOperationError(
                         "Stack didn't create correctly, status is now %s"
                         % create_result)
-                    exit(1)
 
                 # CF told us stack completed ok.
                 # Log message to that effect and refresh the list of stack
                 # objects in CF
-                self.logger.info("Finished creating stack: %s"
-                                 % stack.cf_stack_name)
-                self.cf_desc_stacks = self._describe_all_stacks()
+                self.logger.info("Finished creating stack: %s",
+                                 stack.cf_stack_name)
+                self._refresh_stack(stack.cf_stack_name)
 
-    def delete(self, stack_name=None):
+    def delete(self, stack_name=None, confirmed=False):
         """
         Delete all the stacks from CloudFormation.
         Does this in reverse dependency order.
-        Prompts for confirmation before deleting each stack
+        Prompts once for confirmation before deleting unless confirmed
         """
         # Removing stacks so need to do it in reverse dependency order
-        for stack in reversed(self.stack_objs):
-            if stack_name and stack.name != stack_name:
-                continue
-            self.logger.info("Starting checks for deletion of stack: %s"
-                             % stack.name)
+        to_delete = []
+        for stack in reversed(self._selected_stacks(stack_name)):
+            self.logger.info("Starting checks for deletion of stack: %s",
+                             stack.name)
             if not stack.exists_in_cf(self.cf_desc_stacks):
                 self.logger.info(
-                    "Stack %s doesn't exist in CloudFormation, skipping"
-                    % stack.name)
+                    "Stack %s doesn't exist in CloudFormation, skipping",
+                    stack.name)
             else:
-                confirm = raw_input(
-                    "Confirm you wish to delete stack %s (Name in CF: %s)"
-                    " (type 'yes' if so): "
-                    % (stack.name, stack.cf_stack_name))
-                if not confirm == "yes":
-                    self.logger.info("Not confirmed, skipping...")
-                    continue
-                self.logger.info("Starting delete of stack %s" % stack.name)
-                self.cfconn.delete_stack(stack.cf_stack_name)
-                delete_result = self.watch_events(
-                    stack.cf_stack_name, "DELETE_IN_PROGRESS")
-                if (delete_result != "DELETE_COMPLETE" and
-                   delete_result != "STACK_GONE"):
-                    self.logger.critical(
-                        "Stack didn't delete correctly, status is now %s"
-                        % delete_result)
-                    exit(1)
-
-                # CF told us stack completed ok. Log message to that effect and
-                # refresh the list of stack objects in CF
-                self.logger.info("Finished deleting stack: %s"
-                                 % stack.cf_stack_name)
-                self.cf_desc_stacks = self._describe_all_stacks()
+                to_delete.append(stack)
+        if not to_delete:
+            return
+
+        self.logger.info("Stacks to delete, in this order: %s", ", ".join(
+            "%s (Name in CF: %s)" % (stack.name, stack.cf_stack_name)
+            for stack in to_delete))
+        if not confirmed:
+            confirm = raw_input(
+                "Confirm you wish to delete these %s stacks"
+                " (type 'yes' if so): " % len(to_delete))
+            if not confirm == "yes":
+                self.logger.info("Not confirmed, skipping...")
+                return
+
+        for stack in to_delete:
+            self.logger.info("Starting delete of stack %s", stack.name)
+            self.cfconn.delete_stack(stack.cf_stack_name)
+            delete_result = self.watch_events(
+                stack.cf_stack_name, "DELETE_IN_PROGRESS")
+            if (delete_result != "DELETE_COMPLETE" and
+               delete_result != "STACK_GONE"):
+                raise StackOperationError(
+                    "Stack didn't delete correctly, status is now %s"
+                    % delete_result)
+
+            # CF told us stack completed ok. Log message to that effect and
+            # refresh the list of stack objects in CF
+            self.logger.info("Finished deleting stack: %s",
+                             stack.cf_stack_name)
+            self.cf_stacks_resources.pop(stack.cf_stack_name, None)
+            self.cf_desc_stacks.pop(stack.cf_stack_name, None)
 
     def update(self, stack_name=None):
         """
@@ -342,44 +428,41 @@ class MegaStack(object):
         different to what's currently in CloudFormation.
         If a stack doesn't already exist. Logs critical error and exits.
         """
-        for stack in self.stack_objs:
-            if stack_name and stack.name != stack_name:
-                continue
-            self.logger.info("Starting checks for update of stack: %s"
-                             % stack.name)
+        for stack in self._selected_stacks(stack_name):
+            self.logger.info("Starting checks for update of stack: %s",
+                             stack.name)
             if not stack.exists_in_cf(self.cf_desc_stacks):
-                self.logger.critical(
+                raise StackOperationError(
                     "Stack %s doesn't exist in cloudformation, can't update"
                     " something that doesn't exist." % stack.name)
-                exit(1)
             if not stack.deps_met(self.cf_desc_stacks):
-                self.logger.critical(
+                raise StackOperationError(
                     "Dependencies for stack %s not met and they should be,"
                     " exiting..." % stack.name)
-                exit(1)
             if not stack.populate_params(self.cf_desc_stacks):
-                self.logger.critical("Could not determine correct parameters"
-                                     " for stack %s" % stack.name)
-                exit(1)
+                raise StackOperationError(
+                    "Could not determine correct parameters for stack %s"
+                    % stack.name)
             stack.read_template()
             template_up_to_date = stack.template_uptodate(self.cf_desc_stacks)
             params_up_to_date = stack.params_uptodate(self.cf_desc_stacks)
-            self.logger.debug("Stack is up to date: %s"
-                              % (template_up_to_date and params_up_to_date))
+            self.logger.debug("Stack is up to date: %s",
+                              template_up_to_date and params_up_to_date)
             if template_up_to_date and params_up_to_date:
                 self.logger.info(
                     "Stack %s is already up to date with CloudFormation,"
-                    " skipping..." % stack.name)
+                    " skipping...", stack.name)
             else:
                 if not template_up_to_date:
                     self.logger.info(
-                        "Template for stack %s has changed." % stack.name)
+                        "Template for stack %s has changed.", stack.name)
                     # Would like to get this working. Tried datadiff but can't
                     # stop it from printing whole template
                     # stack.print_template_diff(self.cf_desc_stacks)
+                params = stack.get_params_tuples()
                 self.logger.info(
-                    "Starting update of stack %s with parameters: %s"
-                    % (stack.name, stack.get_params_tuples()))
+                    "Starting update of stack %s with parameters: %s",
+                    stack.name, params)
                 self.cfconn.validate_template(
                     template_body=stack.template_body)
 
@@ -387,7 +470,7 @@ class MegaStack(object):
                     self.cfconn.update_stack(
                         stack_name=stack.cf_stack_name,
                         template_body=stack.template_body,
-                        parameters=stack.get_params_tuples(),
+                        parameters=params,
                         capabilities=[
                             'CAPABILITY_IAM',
                             'CAPABILITY_NAMED_IAM'],
@@ -401,29 +484,29 @@ class MegaStack(object):
                             self.logger.error(
                                 "CloudFormation has no updates to perform on"
                                 " %s, this might be because there is a "
-                                "parameter with NoEcho set" % stack.name)
+                                "parameter with NoEcho set", stack.name)
                             continue
                         else:
                             self.logger.error(
-                                "Got error message: %s"
-                                % e_message_dict["Error"]["Message"])
+                                "Got error message: %s",
+                                e_message_dict["Error"]["Message"])
                             raise exception
                     except simplejson.decoder.JSONDecodeError:
-                        self.logger.critical(
-                            "Unknown error updating stack: %s", exception)
-                        exit(1)
+                        raise StackOperationError(
+                            "Unknown error updating stack: %s" % exception)
                 update_result = self.watch_events(
                     stack.cf_stack_name, [
                         "UPDATE_IN_PROGRESS",
                         "UPDATE_COMPLETE_CLEANUP_IN_PROGRESS"])
                 if update_result != "UPDATE_COMPLETE":
-                    self.logger.critical(
+                    raise StackOperationError(
                         "Stack didn't update correctly, status is now %s"
                         % update_result)
-                    exit(1)
 
                 self.logger.info(
-                    "Finished updating stack: %s" % stack.cf_stack_name)
+                    "Finished updating stack: %s", stack.cf_stack_name)
+                self.cf_stacks_resources.pop(stack.cf_stack_name, None)
+                self._refresh_stack(stack.cf_stack_name)
 
             # avoid getting rate limited
             time.sleep(2)
@@ -434,27 +517,23 @@ class MegaStack(object):
         It will keep watching until its state changes
         """
         if not stack_name:
-            self.logger.critical(
+            raise CumulusException(
                 "No stack name passed in, nothing to watch... use -s to "
                 "provide stack name.")
-            exit(1)
-        the_stack = False
-        for stack in self.stack_objs:
-            if stack_name == stack.name:
-                the_stack = stack
+        the_stack = self.stacks_by_name.get(stack_name)
         if not the_stack:
-            self.logger.error("Cannot find stack %s to watch" % stack_name)
+            self.logger.error("Cannot find stack %s to watch", stack_name)
             return False
         the_cf_stack = the_stack.exists_in_cf(self.cf_desc_stacks)
         if not the_cf_stack:
             self.logger.error(
                 "Stack %s doesn't exist in CloudFormation, can't watch "
-                "something that doesn't exist." % stack_name)
+                "something that doesn't exist.", stack_name)
             return False
 
         self.logger.info(
-            "Watching stack %s, while in state %s."
-            % (the_stack.cf_stack_name, str(the_cf_stack.stack_status)))
+            "Watching stack %s, while in state %s.",
+            the_stack.cf_stack_name, str(the_cf_stack.stack_status))
         self.watch_events(
             the_stack.cf_stack_name, str(the_cf_stack.stack_status))
 
@@ -463,9 +542,17 @@ class MegaStack(object):
         Used by the various actions to watch CloudFormation events
         while a stacks in a given state
         """
+        # Accept a single status or a list of them. Test membership against
+        # a set so a status is never matched as a substring of another,
+        # e.g. UPDATE_COMPLETE in UPDATE_COMPLETE_CLEANUP_IN_PROGRESS
+        if isinstance(while_status, str):
+            while_status = [while_status]
+        while_status = frozenset(while_status)
         try:
             cfstack_obj = self.cfconn.describe_stacks(stack_name)[0]
-            events = list(self.cfconn.describe_stack_events(stack_name))
+            # Only the newest few events are shown before watching for new
+            # ones, so don't read any further pages
+            events = list(islice(self._stack_events(stack_name), 5))
         except boto.exception.BotoServerError as exception:
             if (str(exception.error_message) ==
                "Stack:%s does not exist" % (stack_name)):
@@ -499,12 +586,17 @@ class MegaStack(object):
             'UPDATE_ROLLBACK_COMPLETE': colors['yellow'],
             'UPDATE_FAILED': colors['bred'],
         }
-        # print the last 5 events, so we get to see the start of the action we
-        # are performing
-        self.logger.info("Last 5 events for this stack:")
-        for event in reversed(events[:5]):
-            if self.stackDict[self.name].get('highlight-output', True):
-                self.logger.info("%s %s%s\033[0m %s %s %s %s" % (
+        # Colour by default only when the log is going to a terminal, so
+        # redirected output doesn't fill up with escape codes
+        highlight = self.config.get('highlight-output', sys.stderr.isatty())
+
+        def log_event(event):
+            """
+            Log a single stack event, coloured by status if highlighting
+            """
+            if highlight:
+                self.logger.info(
+                    "%s %s%s\033[0m %s %s %s %s",
                     event.timestamp.isoformat(),
                     status_color_map.get(event.resource_status, ''),
                     event.resource_status,
@@ -512,68 +604,92 @@ class MegaStack(object):
                     event.logical_resource_id,
                     event.physical_resource_id,
                     event.resource_status_reason,
-                ))
+                )
             else:
-                self.logger.info("%s %s %s %s %s %s" % (
+                self.logger.info(
+                    "%s %s %s %s %s %s",
                     event.timestamp.isoformat(),
                     event.resource_status,
                     event.resource_type,
                     event.logical_resource_id,
                     event.physical_resource_id,
                     event.resource_status_reason,
-                ))
+                )
+
+        # print the last 5 events, so we get to see the start of the action we
+        # are performing
+        self.logger.info("Last 5 events for this stack:")
+        for event in reversed(events):
+            log_event(event)
         status = str(cfstack_obj.stack_status)
         self.logger.info("New events:")
+        # Events come back newest first, so remember the newest one we've
+        # seen and stop reading each new batch when we get back to it
+        last_event_id = events[0].event_id if events else None
+        poll_interval = 2
         while status in while_status:
+            events_to_log = []
             try:
-                new_events = list(
-                    self.cfconn.describe_stack_events(stack_name))
+                # Only fetches as many pages as it takes to find the last
+                # event we logged
+                for event in self._stack_events(stack_name):
+                    if event.event_id == last_event_id:
+                        break
+                    events_to_log.append(event)
             except boto.exception.BotoServerError as exception:
                 if (str(exception.error_message) ==
                    "Stack:%s does not exist" % (stack_name)):
                     return "STACK_GONE"
-            count = 0
-            events_to_log = []
-            while (events[0].timestamp != new_events[count].timestamp or
-                   events[0].logical_resource_id !=
-                   new_events[count].logical_resource_id):
-                events_to_log.insert(0, new_events[count])
-                count += 1
+            # Log oldest first
+            events_to_log.reverse()
             for event in events_to_log:
-                if self.stackDict[self.name].get('highlight-output', True):
-                    self.logger.info("%s %s%s\033[0m %s %s %s %s" % (
-                        event.timestamp.isoformat(),
-                        status_color_map.get(event.resource_status, ''),
-                        event.resource_status,
-                        event.resource_type,
-                        event.logical_resource_id,
-                        event.physical_resource_id,
-                        event.resource_status_reason,
-                    ))
-                else:
-                    self.logger.info("%s %s %s %s %s %s" % (
-                        event.timestamp.isoformat(),
-                        event.resource_status,
-                        event.resource_type,
-                        event.logical_resource_id,
-                        event.physical_resource_id,
-                        event.resource_status_reason,
-                    ))
-            if count > 0:
-                events = new_events[:]
-            cfstack_obj.update()
+                log_event(event)
+            # Poll quickly while things are happening and back off while the
+            # stack is quiet, to go easy on the CloudFormation API
+            if events_to_log:
+                last_event_id = events_to_log[-1].event_id
+                poll_interval = 2
+            else:
+                poll_interval = min(poll_interval * 1.5, 15)
+            # Describe through our connection rather than cfstack_obj.update()
+            # so throttled polls are retried. Use the stack id, it can still
+            # be described once the stack is deleted
+            cfstack_obj = self.cfconn.describe_stacks(cfstack_obj.stack_id)[0]
             status = str(cfstack_obj.stack_status)
-            time.sleep(5)
+            time.sleep(poll_interval)
         return status
 
+    def _stack_events(self, stack_name):
+        """
+        Yield the events of a stack newest first, getting further pages
+        from describe_stack_events only when they're needed
+        """
+        next_token = None
+        while True:
+            resp = self.cfconn.describe_stack_events(stack_name, next_token)
+            for event in resp:
+                yield event
+            next_token = resp.next_token
+            if not next_token:
+                return
+
+    def _refresh_stack(self, cf_stack_name):
+        """
+        Update our copy of a single stack after changing it in CF, rather
+        than listing every stack in the region again
+        """
+        self.cf_desc_stacks[cf_stack_name] = self.cfconn.describe_stacks(
+            cf_stack_name)[0]
+
     def _describe_all_stacks(self):
         """
-        Get all pages of stacks from describe_stacks API call.
+        Get all pages of stacks from describe_stacks API call as a dict
+        keyed by stack name.
         """
-        result = []
+        result = {}
         resp = self.cfconn.describe_stacks()
-        result.extend(resp)
+        result.update((str(stack.stack_name), stack) for stack in resp)
         while resp.next_token:
             resp = self.cfconn.describe_stacks(next_token=resp.next_token)
-            result.extend(resp)
+            result.update((str(stack.stack_name), stack) for stack in resp)
         return result
@@ -0,0 +1,49 @@
+"""
+RetryingConnection module. Retries AWS API calls that were throttled.
+"""
+import logging
+import random
+import time
+from boto.exception import BotoServerError
+
+
+class RetryingConnection(object):
+    """
+    Wraps a boto connection and retries any call AWS rejected because we're
+    making requests too quickly, backing off exponentially with jitter.
+    Everything else is passed straight through to the connection.
+    """
+    throttling_codes = frozenset(['Throttling', 'RequestLimitExceeded'])
+
+    def __init__(self, connection, max_attempts=8, base_delay=1,
+                 max_delay=30):
+        self.logger = logging.getLogger(__name__)
+        self.connection = connection
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def __getattr__(self, name):
+        attr = getattr(self.connection, name)
+        if not callable(attr):
+            return attr
+
+        def call_with_retries(*args, **kwargs):
+            """
+            Call the connection method, sleeping and trying again while
+            it's throttled
+            """
+            for attempt in range(self.max_attempts):
+                try:
+                    return attr(*args, **kwargs)
+                except BotoServerError as exception:
+                    if (exception.error_code not in self.throttling_codes or
+                            attempt == self.max_attempts - 1):
+                        raise
+                    delay = random.uniform(
+                        0, min(self.max_delay, self.base_delay * 2 ** attempt))
+                    self.logger.debug(
+                        "%s was throttled, retrying in %.1f seconds",
+                        name, delay)
+                    time.sleep(delay)
+        return call_with_retries
@@ -0,0 +1,34 @@
+"""
+Exceptions raised by cumulus
+"""
+
+
+class CumulusException(Exception):
+    """
+    Base class for errors raised by cumulus
+    """
+    pass
+
+
+class InvalidStackDefinition(CumulusException):
+    """
+    A stack in the yaml file can't be used as defined, e.g. its template
+    can't be read or one of its parameters can't be resolved
+    """
+    pass
+
+
+class StackOperationError(CumulusException):
+    """
+    Creating, updating or deleting a stack in CloudFormation couldn't be
+    started or didn't finish successfully
+    """
+    pass
+
+
+class ConfigError(CumulusException):
+    """
+    The mega stack yaml file can't be used, e.g. it's missing its region or
+    it doesn't match the AWS account or region we're connected to
+    """
+    pass